@@ -1,20 +1,162 @@
 from langchain.agents import AgentExecutor, create_openai_tools_agent
 from langchain_openai import ChatOpenAI
-from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
-from langchain.tools import tool
+from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain.tools import StructuredTool, tool
 from langchain.memory import ConversationBufferMemory
-from typing import List, Dict, Any, Tuple
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Any, Optional, Set, Tuple
+from collections import deque
 from datetime import datetime
+import asyncio
+import hashlib
+import logging
+import re
+from functools import lru_cache
+from cachetools import LRUCache
+import orjson
 from langsmith import Client
+import openai
+from tenacity import AsyncRetrying, retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from langchain.callbacks.tracers import LangChainTracer
-from langchain.callbacks.manager import CallbackManager
 
 from app.config import get_settings
 from app.calendar import ReservationCalendar
 
-def get_langsmith_client():
+logger = logging.getLogger(__name__)
+
+_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# Short acknowledgements answered without a full agent round-trip. Bare "yes"
+# is deliberately absent: it usually answers a question and needs the agent.
+_FAST_PATH_RESPONSES = {
+    **dict.fromkeys(
+        ["ok", "okay", "alright", "all right", "sure", "got it", "great", "perfect"],
+        "Great, thank you."
+    ),
+    **dict.fromkeys(
+        ["thanks", "thank you", "thank you very much", "thanks a lot"],
+        "Thank you!"
+    ),
+}
+_PUNCTUATION_RE = re.compile(r"[^\w\s']")
+
+# Rate limits and timeouts are transient; auth and validation errors are not
+_TRANSIENT_LLM_ERRORS = (openai.RateLimitError, openai.APITimeoutError)
+_LLM_RETRY = {
+    "stop": stop_after_attempt(3),
+    "wait": wait_exponential(multiplier=1, min=2, max=20),
+    "retry": retry_if_exception_type(_TRANSIENT_LLM_ERRORS),
+    "reraise": True
+}
+
+# Maximum number of chat history entries re-sent to the LLM on every turn
+HISTORY_LIMIT = 20
+
+SUMMARY_PROMPT = (
+    "Summarize this earlier part of a phone call between a restaurant "
+    "and a customer making a reservation in two or three sentences. "
+    "Keep any details that were agreed on."
+)
+
+SYSTEM_PROMPT = """
+You are a customer calling a restaurant to make a reservation. Behave like a real person.
+
+- Only provide reservation details when specifically asked.
+- Never repeat or confirm the reservation unless the staff explicitly asks you to do so.
+- If the staff says the reservation is confirmed, just thank them and do not repeat the details.
+- If the staff greets you or asks how they can help, say you want to make a reservation for a table.
+- Be polite, concise, and natural in your responses.
+- Use the provided tools only when appropriate and after all details are clarified.
+"""
+
+# Prompt templates are built once at import and shared by all executors.
+# The shared agent prompt: system prompt, chat history, then the new turn.
+# Static instructions come first and reservation details last, so the system
+# prefix stays byte-identical and eligible for prompt caching.
+_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", SYSTEM_PROMPT + """
+Your reservation details are:
+  - Date: {date}
+  - Time: {time}
+  - Number of people: {people}
+  - Customer name: {name}
+"""),
+    MessagesPlaceholder(variable_name="chat_history"),
+    ("human", "{input}"),
+    MessagesPlaceholder(variable_name="agent_scratchpad"),
+])
+
+# Prompt for the standalone assistant built by initialize_agent
+_ASSISTANT_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """You are a helpful restaurant reservation assistant.
+        Current reservation details:
+        - Date: {date}
+        - Time: {time}
+        - Number of people: {people}
+        - Customer name: {name}
+        
+        Help the customer with their reservation request.
+        Always be polite and professional.
+        
+        You have access to the following tools:
+        - check_availability: Check if a table is available for a given date and time
+        
+        Use these tools to help customers make reservations."""),
+    MessagesPlaceholder(variable_name="chat_history"),
+    ("human", "{input}"),
+    MessagesPlaceholder(variable_name="agent_scratchpad"),
+])
+
+def prompt_variables(reservation_params: Dict[str, Any]) -> Dict[str, Any]:
+    """Get the reservation detail variables expected by the shared agent prompt."""
+    return {
+        "date": reservation_params.get("date", ""),
+        "time": reservation_params.get("time", ""),
+        "people": reservation_params.get("people", ""),
+        "name": reservation_params.get("name", "")
+    }
+
+def parse_tool_date(date: str) -> datetime:
+    """Parse a YYYY-MM-DD date passed to a tool, raising ValueError if it is invalid."""
+    if not _DATE_RE.match(date):
+        raise ValueError(f"Invalid date format: {date}. Expected YYYY-MM-DD.")
+    return datetime.fromisoformat(date)
+
+def fast_path_response(message: str) -> Optional[str]:
+    """Get a canned response for a trivial acknowledgement, or None if the agent is needed."""
+    normalized = " ".join(_PUNCTUATION_RE.sub("", message.lower()).split())
+    return _FAST_PATH_RESPONSES.get(normalized)
+
+@lru_cache(maxsize=1)
+def get_langsmith_client() -> Optional[Client]:
+    """Get cached LangSmith client, or None when no LangSmith API key is configured."""
+    if not get_settings().langsmith_api_key:
+        return None
     return Client()
 
+@lru_cache(maxsize=1)
+def _create_tracer(client: Client) -> LangChainTracer:
+    return LangChainTracer(
+        project_name="restaurant-reservation-agent",
+        client=client
+    )
+
+def get_tracer() -> Optional[LangChainTracer]:
+    """Get the shared LangSmith tracer, or None when tracing is disabled."""
+    client = get_langsmith_client()
+    if client is None:
+        return None
+    return _create_tracer(client)
+
+def get_cache_control(model: str) -> Optional[Dict[str, Any]]:
+    """
+    Get the request body extension enabling prompt caching for the model.
+    OpenAI models cache long, stable prefixes automatically; Anthropic models
+    routed through OpenRouter need an explicit cache_control breakpoint.
+    """
+    if model.startswith("anthropic/"):
+        return {"cache_control": {"type": "ephemeral"}}
+    return None
+
 class ReservationAgent:
     """
     Stateless agent factory for handling restaurant reservations.
@@ -22,18 +164,42 @@ class ReservationAgent:
     """
     def __init__(self):
         self.settings = get_settings()
-        tracer = LangChainTracer(
-            project_name="restaurant-reservation-agent",
-            client=get_langsmith_client()
-        )
+        tracer = get_tracer()
         self.llm = ChatOpenAI(
             api_key=self.settings.openrouter_api_key,
-            model="openai/gpt-4o",
+            model=self.settings.llm_model,
             temperature=0.7,
             base_url="https://openrouter.ai/api/v1",
-            callbacks=[tracer]
+            max_retries=4,
+            timeout=30,
+            callbacks=[tracer] if tracer else None,
+            extra_body=get_cache_control(self.settings.llm_model),
+            streaming=True
+        )
+        # Cheap model used to summarize old chat history
+        self.summary_llm = ChatOpenAI(
+            api_key=self.settings.openrouter_api_key,
+            model="openai/gpt-4o-mini",
+            temperature=0,
+            base_url="https://openrouter.ai/api/v1",
+            max_retries=4,
+            timeout=30,
+            callbacks=[tracer] if tracer else None
         )
         self.tools = self._create_tools()
+        # One executor shared by all sessions; the reservation details are
+        # passed as prompt variables on every invocation.
+        self.executor = self.create_agent_with_prompt(_PROMPT)
+        # Batches retry only the inputs that failed with a transient error
+        self.batch_executor = self.executor.with_retry(
+            retry_if_exception_type=_TRANSIENT_LLM_ERRORS,
+            stop_after_attempt=3
+        )
+        # Replies keyed by reservation details, history and message, so
+        # entries never cross calls for different reservations.
+        self.response_cache: Optional[LRUCache] = (
+            LRUCache(maxsize=2048) if self.settings.response_cache_enabled else None
+        )
 
     def _create_tools(self) -> List:
         """Create tools for the agent."""
@@ -63,32 +229,6 @@ class ReservationAgent:
         
         return [check_availability, make_reservation]
 
-    def build_prompt(self, reservation_params: Dict[str, Any]) -> ChatPromptTemplate:
-        """
-        Build a session-specific prompt with reservation parameters.
-        The agent is always the caller, making a reservation with these details.
-        """
-        return ChatPromptTemplate.from_messages([
-            ("system", f"""
-You are a customer calling a restaurant to make a reservation. Behave like a real person.
-
-- Only provide reservation details when specifically asked.
-- Never repeat or confirm the reservation unless the staff explicitly asks you to do so.
-- If the staff says the reservation is confirmed, just thank them and do not repeat the details.
-- If the staff greets you or asks how they can help, say you want to make a reservation for a table.
-- Be polite, concise, and natural in your responses.
-- Your reservation details are:
-  - Date: {reservation_params.get('date', '')}
-  - Time: {reservation_params.get('time', '')}
-  - Number of people: {reservation_params.get('people', '')}
-  - Customer name: {reservation_params.get('name', '')}
-- Use the provided tools only when appropriate and after all details are clarified.
-"""),
-            MessagesPlaceholder(variable_name="chat_history"),
-            ("human", "{input}"),
-            MessagesPlaceholder(variable_name="agent_scratchpad"),
-        ])
-
     def create_agent_with_prompt(self, prompt: ChatPromptTemplate) -> AgentExecutor:
         agent = create_openai_tools_agent(
             llm=self.llm,
@@ -98,7 +238,7 @@ You are a customer calling a restaurant to make a reservation. Behave like a rea
         return AgentExecutor(
             agent=agent,
             tools=self.tools,
-            verbose=True
+            verbose=self.settings.debug
         )
 
 class ReservationSession:
@@ -109,18 +249,224 @@ class ReservationSession:
     def __init__(self, agent: ReservationAgent, reservation_params: dict):
         self.agent = agent
         self.reservation_params = reservation_params
-        self.chat_history = []
+        self.executor = agent.executor
+        # Computed once, so every turn sends the same system prefix
+        self._prompt_vars = prompt_variables(reservation_params)
+        self.chat_history = deque(maxlen=HISTORY_LIMIT)
+        # Number of Retell transcript entries already seen by this session
+        self.last_transcript_len = 0
+        # In-flight reply to the latest turn, cancelled if a newer turn arrives
+        self.response_task: Optional[asyncio.Task] = None
+        # Background summary of old history, kept off the reply path
+        self._compaction_task: Optional[asyncio.Task] = None
+        # Awaited once compaction has replaced the history, e.g. to persist it
+        self.on_compacted: Optional[Callable[[], Awaitable[Any]]] = None
+
+    def to_state(self) -> Dict[str, Any]:
+        """Serialize the session to a JSON-compatible dict for a session store."""
+        return {
+            "params": self.reservation_params,
+            "history": list(self.chat_history),
+            "last_transcript_len": self.last_transcript_len
+        }
 
+    @classmethod
+    def from_state(cls, agent: ReservationAgent, state: Dict[str, Any]) -> "ReservationSession":
+        """Rebuild a session from a dict produced by to_state."""
+        session = cls(agent, state["params"])
+        session.chat_history = deque(state["history"], maxlen=HISTORY_LIMIT)
+        session.last_transcript_len = state.get("last_transcript_len", 0)
+        return session
+
+    @retry(**_LLM_RETRY)
     async def process_message(self, message: str) -> str:
-        prompt = self.agent.build_prompt(self.reservation_params)
-        temp_agent = self.agent.create_agent_with_prompt(prompt)
-        response = await temp_agent.ainvoke({
+        cache = self.agent.response_cache
+        key = self._cache_key(message) if cache is not None else None
+        if key is not None and key in cache:
+            output = cache[key]
+        else:
+            response = await self.executor.ainvoke({
+                **self._prompt_vars,
+                "input": message,
+                "chat_history": list(self.chat_history)
+            })
+            output = response["output"]
+            if key is not None:
+                cache[key] = output
+        self._record_exchange(message, output)
+        return output
+
+    async def process_message_stream(self, message: str) -> AsyncIterator[str]:
+        """Process a message, yielding response tokens as the LLM generates them."""
+        cache = self.agent.response_cache
+        key = self._cache_key(message) if cache is not None else None
+        if key is not None and key in cache:
+            output = cache[key]
+            yield output
+            self._record_exchange(message, output)
+            return
+        # Transient errors are retried until the first token arrives; after
+        # that, part of the reply has already been sent to the caller
+        async for attempt in AsyncRetrying(**_LLM_RETRY):
+            with attempt:
+                contents = self._stream_content(message)
+                first = await anext(contents, None)
+        chunks = []
+        if first is not None:
+            chunks.append(first)
+            yield first
+            async for content in contents:
+                chunks.append(content)
+                yield content
+        output = "".join(chunks)
+        if key is not None:
+            cache[key] = output
+        self._record_exchange(message, output)
+
+    async def _stream_content(self, message: str) -> AsyncIterator[str]:
+        """Yield the text content streamed by the agent's chat model."""
+        async for event in self.executor.astream_events({
+            **self._prompt_vars,
             "input": message,
-            "chat_history": self.chat_history
-        })
+            "chat_history": list(self.chat_history)
+        }, version="v2"):
+            if event["event"] != "on_chat_model_stream":
+                continue
+            # Tool-calling steps stream chunks without text content
+            content = event["data"]["chunk"].content
+            if content:
+                yield content
+
+    def _cache_key(self, message: str) -> bytes:
+        """Hash the prompt variables, chat history and message into a response cache key."""
+        payload = orjson.dumps([self._prompt_vars, list(self.chat_history), message])
+        return hashlib.blake2b(payload, digest_size=16).digest()
+
+    async def process_fast_path(self, message: str) -> Optional[str]:
+        """Answer a trivial acknowledgement without invoking the agent, if possible."""
+        response = fast_path_response(message)
+        if response is not None:
+            self._record_exchange(message, response)
+        return response
+
+    def _record_exchange(self, message: str, response: str):
         self.chat_history.append({"role": "user", "content": message})
-        self.chat_history.append({"role": "assistant", "content": response["output"]})
-        return response["output"]
+        self.chat_history.append({"role": "assistant", "content": response})
+        # Summarize in the background one turn before the bounded deque starts
+        # dropping entries, so replies never wait for the summary LLM
+        if len(self.chat_history) >= HISTORY_LIMIT - 2 and (
+            self._compaction_task is None or self._compaction_task.done()
+        ):
+            self._compaction_task = asyncio.create_task(self._compact_history())
+
+    async def _compact_history(self):
+        """Collapse the oldest half of the chat history into a single summary entry."""
+        oldest = list(self.chat_history)[:HISTORY_LIMIT // 2]
+        transcript = "\n".join(f"{entry['role']}: {entry['content']}" for entry in oldest)
+        try:
+            summary = await self.agent.summary_llm.ainvoke([
+                ("system", SUMMARY_PROMPT),
+                ("human", transcript)
+            ])
+        except Exception as e:
+            # The bounded deque drops the oldest entries instead
+            logger.warning("Failed to summarize chat history: %s", e)
+            return
+        # Turns recorded while the summary was generated are kept
+        summarized = {id(entry) for entry in oldest}
+        self.chat_history = deque(
+            [
+                {"role": "system", "content": f"Earlier: {summary.content}"},
+                *(entry for entry in self.chat_history if id(entry) not in summarized)
+            ],
+            maxlen=HISTORY_LIMIT
+        )
+        if self.on_compacted is not None:
+            await self.on_compacted()
+
+class ChatBatcher:
+    """
+    Micro-batches concurrent chat requests into AgentExecutor.abatch calls.
+    Requests are collected until max_batch_size arrive or max_wait seconds pass.
+    """
+    def __init__(self, agent: ReservationAgent, max_batch_size: int = 8, max_wait: float = 0.02):
+        self.agent = agent
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        # Batches in flight; the worker doesn't wait for one before the next
+        self._flushes: Set[asyncio.Task] = set()
+
+    async def submit(
+        self,
+        message: str,
+        chat_history: Optional[List[Dict[str, str]]] = None,
+        reservation_params: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """Queue a message for the next batch and wait for the agent's response."""
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((message, chat_history or [], reservation_params or {}, future))
+        return await future
+
+    async def aclose(self):
+        """Stop the background batching task and any batches in flight."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        for task in self._flushes:
+            task.cancel()
+        await asyncio.gather(*self._flushes, return_exceptions=True)
+        self._flushes.clear()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[Tuple]):
+        inputs = [
+            {
+                **prompt_variables(reservation_params),
+                "input": message,
+                "chat_history": chat_history
+            }
+            for message, chat_history, reservation_params, _ in batch
+        ]
+        try:
+            # max_concurrency must be explicit, otherwise abatch runs serially
+            outputs = await self.agent.batch_executor.abatch(
+                inputs,
+                config={"max_concurrency": self.max_batch_size},
+                return_exceptions=True
+            )
+        except Exception as e:
+            outputs = [e] * len(batch)
+        for (_, _, _, future), output in zip(batch, outputs):
+            if future.done():
+                continue
+            if isinstance(output, Exception):
+                future.set_exception(output)
+            else:
+                future.set_result(output["output"])
 
 def initialize_agent(reservation_params: Dict[str, Any]) -> AgentExecutor:
     """
@@ -136,29 +482,28 @@ def initialize_agent(reservation_params: Dict[str, Any]) -> AgentExecutor:
     settings = get_settings()
     
     # Configure LangSmith tracing
-    tracer = LangChainTracer(
-        project_name="restaurant-reservation-agent",
-        client=get_langsmith_client()
-    )
+    tracer = get_tracer()
     
     # Initialize LLM with OpenRouter
     llm = ChatOpenAI(
         api_key=settings.openrouter_api_key,
-        model="openai/gpt-4o",
+        model=settings.llm_model,
         temperature=0.3,
         base_url="https://openrouter.ai/api/v1",
-        callbacks=[tracer]
+        max_retries=4,
+        timeout=30,
+        callbacks=[tracer] if tracer else None,
+        extra_body=get_cache_control(settings.llm_model)
     )
     
     # Create calendar instance
     calendar = ReservationCalendar()
     
     # Define tools
-    @tool
     def check_availability(date: str, time: str) -> Dict[str, Any]:
         """Check table availability for a given date and time."""
         try:
-            date_obj = datetime.strptime(date, "%Y-%m-%d")
+            date_obj = parse_tool_date(date)
             is_available = calendar.check_availability(
                 date=date_obj,
                 time=time,
@@ -173,30 +518,35 @@ def initialize_agent(reservation_params: Dict[str, Any]) -> AgentExecutor:
             }
         except Exception as e:
             return {"error": str(e)}
+
+    async def acheck_availability(date: str, time: str) -> Dict[str, Any]:
+        """Check table availability for a given date and time."""
+        try:
+            date_obj = parse_tool_date(date)
+            party_size = reservation_params.get("people", 2)
+            # Both lookups are independent, so run them concurrently
+            is_available, suggested_times = await asyncio.gather(
+                calendar.acheck_availability(
+                    date=date_obj,
+                    time=time,
+                    party_size=party_size
+                ),
+                calendar.aget_available_times(date_obj, party_size)
+            )
+            return {
+                "available": is_available,
+                "suggested_times": suggested_times
+            }
+        except Exception as e:
+            return {"error": str(e)}
+
+    check_availability = StructuredTool.from_function(
+        func=check_availability,
+        coroutine=acheck_availability
+    )
     
     tools = [check_availability]
     
-    # Create prompt template
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", """You are a helpful restaurant reservation assistant.
-        Current reservation details:
-        - Date: {date}
-        - Time: {time}
-        - Number of people: {people}
-        - Customer name: {name}
-        
-        Help the customer with their reservation request.
-        Always be polite and professional.
-        
-        You have access to the following tools:
-        - check_availability: Check if a table is available for a given date and time
-        
-        Use these tools to help customers make reservations."""),
-        MessagesPlaceholder(variable_name="chat_history"),
-        ("human", "{input}"),
-        MessagesPlaceholder(variable_name="agent_scratchpad"),
-    ])
-    
     # Initialize memory
     memory = ConversationBufferMemory(
         memory_key="chat_history",
@@ -207,7 +557,7 @@ def initialize_agent(reservation_params: Dict[str, Any]) -> AgentExecutor:
     agent = create_openai_tools_agent(
         llm=llm,
         tools=tools,
-        prompt=prompt
+        prompt=_ASSISTANT_PROMPT
     )
     
     # Create and return agent executor
@@ -215,5 +565,5 @@ def initialize_agent(reservation_params: Dict[str, Any]) -> AgentExecutor:
         agent=agent,
         tools=tools,
         memory=memory,
-        verbose=True
+        verbose=settings.debug
     ) 
\ No newline at end of file
@@ -1,8 +1,16 @@
-from datetime import datetime
-from typing import List, Dict, Optional
+from collections import defaultdict
+from itertools import count
+from datetime import date as Date, datetime
+from typing import List, Dict, Optional, Tuple
 from pydantic import BaseModel
 
 
+_DEFAULT_SLOTS: Tuple[str, ...] = (
+    "11:00", "11:30", "12:00", "12:30", "13:00", "13:30",
+    "18:00", "18:30", "19:00", "19:30", "20:00", "20:30"
+)
+
+
 class Reservation(BaseModel):
     """Reservation model."""
     reservation_id: str
@@ -16,8 +24,14 @@ class Reservation(BaseModel):
 class ReservationCalendar:
     """Calendar for managing restaurant reservations."""
     
-    def __init__(self):
+    def __init__(self, slot_capacity: int = 40):
+        self.slot_capacity = slot_capacity
         self.reservations: Dict[str, Reservation] = {}
+        # Booked party size per (date, time slot), so availability queries
+        # don't scan the reservations
+        self._slot_load: Dict[Tuple[Date, str], int] = defaultdict(int)
+        self._id_prefix = f"RES-{datetime.now().strftime('%Y%m%d')}"
+        self._id_counter = count(1)
     
     def add_reservation(
         self,
@@ -27,7 +41,7 @@ class ReservationCalendar:
         phone_number: str
     ) -> Reservation:
         """Add a new reservation to the calendar."""
-        reservation_id = f"RES-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        reservation_id = f"{self._id_prefix}-{next(self._id_counter):06d}"
         
         reservation = Reservation(
             reservation_id=reservation_id,
@@ -38,6 +52,7 @@ class ReservationCalendar:
         )
         
         self.reservations[reservation_id] = reservation
+        self._slot_load[(date.date(), date.strftime("%H:%M"))] += party_size
         return reservation
     
     def get_reservation(self, reservation_id: str) -> Optional[Reservation]:
@@ -46,10 +61,14 @@ class ReservationCalendar:
     
     def cancel_reservation(self, reservation_id: str) -> bool:
         """Cancel a reservation."""
-        if reservation_id in self.reservations:
-            self.reservations[reservation_id].status = "cancelled"
-            return True
-        return False
+        reservation = self.reservations.get(reservation_id)
+        if reservation is None:
+            return False
+        if reservation.status != "cancelled":
+            reservation.status = "cancelled"
+            slot = (reservation.date.date(), reservation.date.strftime("%H:%M"))
+            self._slot_load[slot] -= reservation.party_size
+        return True
     
     def get_available_times(
         self,
@@ -57,11 +76,10 @@ class ReservationCalendar:
         party_size: int
     ) -> List[str]:
         """Get available reservation times for a given date and party size."""
-        # TODO: Implement actual availability checking logic
-        # This is a placeholder implementation
+        day = date.date()
         return [
-            "11:00", "11:30", "12:00", "12:30", "13:00", "13:30",
-            "18:00", "18:30", "19:00", "19:30", "20:00", "20:30"
+            slot for slot in _DEFAULT_SLOTS
+            if self._slot_load.get((day, slot), 0) + party_size <= self.slot_capacity
         ]
     
     def check_availability(
@@ -71,6 +89,23 @@ class ReservationCalendar:
         party_size: int
     ) -> bool:
         """Check if a specific time slot is available."""
-        # TODO: Implement actual availability checking logic
-        # This is a placeholder implementation
-        return True 
\ No newline at end of file
+        load = self._slot_load.get((date.date(), time), 0)
+        return load + party_size <= self.slot_capacity
+ 
+
+    async def aget_available_times(
+        self,
+        date: datetime,
+        party_size: int
+    ) -> List[str]:
+        """Async variant of get_available_times."""
+        return self.get_available_times(date, party_size)
+
+    async def acheck_availability(
+        self,
+        date: datetime,
+        time: str,
+        party_size: int
+    ) -> bool:
+        """Async variant of check_availability."""
+        return self.check_availability(date, time, party_size)
@@ -1,7 +1,9 @@
 import os
+from dataclasses import dataclass, fields
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
 from functools import lru_cache
+from typing import List, Tuple
 
 
 # Load environment variables from .env file
@@ -14,16 +16,35 @@ class Settings(BaseSettings):
     # API Keys
     openrouter_api_key: str = os.getenv("OPENROUTER_API_KEY", "")
     retell_api_key: str = os.getenv("RETELL_API_KEY", "")
+    langsmith_api_key: str = os.getenv(
+        "LANGSMITH_API_KEY",
+        os.getenv("LANGCHAIN_API_KEY", "")
+    )
     google_credentials_path: str = os.getenv(
         "GOOGLE_CREDENTIALS_PATH",
         "./google_credentials.json"
     )
     
+    # LLM settings
+    llm_model: str = os.getenv("LLM_MODEL", "openai/gpt-4o-2024-11-20")
+    response_cache_enabled: bool = os.getenv("RESPONSE_CACHE_ENABLED", "False").lower() == "true"
+
     # Application settings
     debug: bool = os.getenv("DEBUG", "False").lower() == "true"
+    dev_mode: bool = os.getenv("DEV_MODE", "False").lower() == "true"
     host: str = os.getenv("HOST", "0.0.0.0")
     port: int = int(os.getenv("PORT", "8000"))
+    workers: int = int(os.getenv("WORKERS", "1"))
+    cors_origins: List[str] = [
+        origin.strip()
+        for origin in os.getenv("CORS_ORIGINS", "").split(",")
+        if origin.strip()
+    ]
     
+    # Session storage
+    redis_url: str = os.getenv("REDIS_URL", "")
+    session_ttl: int = int(os.getenv("SESSION_TTL", "3600"))
+
     # Restaurant settings
     restaurant_name: str = "Pizza Palace"
     restaurant_phone: str = "+1234567890"
@@ -38,7 +59,39 @@ class Settings(BaseSettings):
     }
 
 
+@dataclass(frozen=True, slots=True)
+class FrozenSettings:
+    """Immutable snapshot of Settings with plain slot attribute access."""
+
+    openrouter_api_key: str
+    retell_api_key: str
+    langsmith_api_key: str
+    google_credentials_path: str
+    llm_model: str
+    response_cache_enabled: bool
+    debug: bool
+    dev_mode: bool
+    host: str
+    port: int
+    workers: int
+    cors_origins: Tuple[str, ...]
+    redis_url: str
+    session_ttl: int
+    restaurant_name: str
+    restaurant_phone: str
+    max_party_size: int
+    opening_hour: int
+    closing_hour: int
+
+
 @lru_cache()
-def get_settings() -> Settings:
+def get_settings() -> FrozenSettings:
     """Get cached settings instance."""
-    return Settings() 
\ No newline at end of file
+    settings = Settings()
+    values = {
+        field.name: getattr(settings, field.name)
+        for field in fields(FrozenSettings)
+    }
+    values["cors_origins"] = tuple(values["cors_origins"])
+    return FrozenSettings(**values)
+ 
\ No newline at end of file
@@ -1,11 +1,25 @@
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+import os
+
+# Run LangChain callbacks (e.g. tracing) in the background, off the request path.
+# Must be set before langchain is imported.
+os.environ.setdefault("LANGCHAIN_CALLBACKS_BACKGROUND", "true")
+
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import Optional, List, Dict
-from app.agent import ReservationAgent, ReservationSession
+from typing import AsyncIterator, Optional, List, Dict, Any
+from app.agent import ReservationAgent, ReservationSession, ChatBatcher
+import asyncio
 import logging
+import logging.handlers
+import queue
 import httpx
+import orjson
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 from app.config import get_settings
+from app.sessions import create_session_store
 
 logging.basicConfig(
     level=logging.INFO,
@@ -19,36 +33,79 @@ for logger_name in [
 ]:
     logging.getLogger(logger_name).setLevel(logging.WARNING)
 
+settings = get_settings()
+
+# Per-request values bound once at import
+RETELL_API_KEY = settings.retell_api_key
+HOST = settings.host
+# Public LLM endpoint (ngrok url); Retell substitutes {call_id} itself
+LLM_URL_TEMPLATE = f"{HOST}/llm-websocket/{{call_id}}"
+
+async def make_retell_client() -> httpx.AsyncClient:
+    """Create the shared client so Retell API calls reuse pooled keep-alive connections."""
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=100,
+            max_keepalive_connections=20,
+            keepalive_expiry=300
+        ),
+        timeout=httpx.Timeout(10.0, connect=3.0)
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    dialog_listener.start()
+    # Build the agent in a worker thread while the Retell client is created
+    app.state.agent, app.state.retell_client = await asyncio.gather(
+        asyncio.to_thread(ReservationAgent),
+        make_retell_client()
+    )
+    app.state.chat_batcher = ChatBatcher(app.state.agent)
+    yield
+    await app.state.chat_batcher.aclose()
+    await session_store.aclose()
+    await app.state.retell_client.aclose()
+    dialog_listener.stop()
+
 app = FastAPI(
     title="Voice Reserve AI",
     description="AI-powered restaurant reservation system",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=list(settings.cors_origins),
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
+    # Browsers cache the preflight response for a day
+    max_age=86400,
 )
 
-# Initialize the agent
-agent = ReservationAgent()
-sessions: Dict[str, ReservationSession] = {}
+session_store = create_session_store(settings)
 
 # Create a separate logger for dialog messages
+# Records are only enqueued on the event loop; a listener thread started in
+# the lifespan formats them and writes to the stream.
 dialog_logger = logging.getLogger("dialog")
 dialog_logger.setLevel(logging.INFO)
 dialog_handler = logging.StreamHandler()
 dialog_formatter = logging.Formatter('%(message)s')
 dialog_handler.setFormatter(dialog_formatter)
-dialog_logger.handlers = [dialog_handler]
+dialog_queue: queue.SimpleQueue = queue.SimpleQueue()
+dialog_listener = logging.handlers.QueueListener(dialog_queue, dialog_handler)
+dialog_logger.handlers = [logging.handlers.QueueHandler(dialog_queue)]
+dialog_logger.propagate = False
 
 class ChatRequest(BaseModel):
     message: str
     chat_history: Optional[List[Dict[str, str]]] = None
+    reservation_params: Optional[Dict[str, Any]] = None
 
 class ChatResponse(BaseModel):
     response: str
@@ -60,7 +117,27 @@ class ReservationRequest(BaseModel):
     name: str
     phone_number: str  # pizzeria phone number
 
+def is_transient_retell_error(error: BaseException) -> bool:
+    """
+    Check whether a Retell API error is safe to retry.
+    Only errors where the call cannot have been placed are retried: read
+    timeouts, 502 and 504 may follow a call that was already started.
+    """
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    return (
+        isinstance(error, httpx.HTTPStatusError)
+        and error.response.status_code == 503
+    )
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential_jitter(initial=0.2, max=2.0),
+    retry=retry_if_exception(is_transient_retell_error),
+    reraise=True
+)
 async def initiate_retell_call(
+    client: httpx.AsyncClient,
     api_key: str,
     phone_number: str,
     llm_url: str,
@@ -76,12 +153,79 @@ async def initiate_retell_call(
         "custom_llm_url": llm_url,
         "metadata": metadata or {}
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        return response.json()
+    response = await client.post(url, json=payload, headers=headers)
+    response.raise_for_status()
+    return response.json()
+
+# Largest websocket frame accepted from Retell, in bytes (characters for text frames)
+MAX_FRAME_SIZE = 1_048_576
+
+# Hardcoded test data for manual Retell UI tests, which send no metadata.
+# Only used in dev mode, so real calls that lose their metadata fail loudly.
+_FALLBACK_PARAMS = {
+    "date": "2024-03-20",
+    "time": "19:00",
+    "people": 4,
+    "name": "John Doe"
+} if settings.dev_mode else None
+
+# Streamed deltas are buffered until they reach this many characters
+MIN_STREAM_CHUNK = 20
+
+# Constant frames, encoded once. The initial empty message lets the user
+# (pizzeria) speak first.
+_INITIAL_FRAME = orjson.dumps({"content": "", "content_complete": True}).decode()
+_NO_MESSAGE_ERROR = orjson.dumps({"error": "No message provided.", "content_complete": True}).decode()
+
+async def receive_frame(websocket: WebSocket) -> Any:
+    """
+    Receive a JSON text or binary frame and decode the raw payload with orjson.
+    Oversized frames close the connection with 1009 and return None unparsed.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    raw = message.get("bytes")
+    if raw is None:
+        raw = message["text"]
+    if len(raw) > MAX_FRAME_SIZE:
+        logging.error("Closing websocket: frame of %d exceeds %d", len(raw), MAX_FRAME_SIZE)
+        await websocket.close(code=1009)
+        return None
+    return orjson.loads(raw)
+
+async def iter_frames(websocket: WebSocket) -> AsyncIterator[Any]:
+    """
+    Iterate over decoded frames until the connection is closed for an oversized frame.
+    Unlike Starlette's iter_json, WebSocketDisconnect propagates to the caller.
+    """
+    while True:
+        data = await receive_frame(websocket)
+        if data is None:
+            return
+        yield data
+
+async def send_frame(websocket: WebSocket, payload: Dict[str, Any]):
+    """
+    Send a JSON frame encoded with orjson.
+    Sent as a text frame, since Retell's custom LLM protocol expects text messages.
+    """
+    await websocket.send_text(orjson.dumps(payload).decode())
+
+def latest_user_message(transcript: List[Dict[str, Any]], start: int = 0) -> Optional[str]:
+    """
+    Get the content of the most recent user entry in a Retell transcript.
+    Only entries from index start onwards are scanned, without copying the list.
+    """
+    return next(
+        (
+            transcript[i].get("content")
+            for i in range(len(transcript) - 1, start - 1, -1)
+            if transcript[i].get("role") == "user"
+        ),
+        None
+    )
 
-settings = get_settings()
 
 @app.get("/")
 async def root():
@@ -99,53 +243,124 @@ async def health_check():
         "version": "0.1.0"
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Runtime metrics endpoint."""
+    return {
+        "sessions": await session_store.count()
+    }
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request):
     """Process a chat message and return the agent's response."""
     try:
-        response = await agent.process_message(
+        response = await http_request.app.state.chat_batcher.submit(
             message=request.message,
-            chat_history=request.chat_history
+            chat_history=request.chat_history,
+            reservation_params=request.reservation_params
         )
         return ChatResponse(response=response)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def respond_to_turn(
+    websocket: WebSocket,
+    session: ReservationSession,
+    call_id: str,
+    message: str,
+    response_id: Optional[int]
+):
+    """Generate and send the agent's reply to one user turn."""
+    try:
+        # Only log dialog messages explicitly
+        dialog_logger.info("[User -> Agent] %s", message)
+
+        # Answer trivial acknowledgements without an LLM round-trip
+        response = await session.process_fast_path(message)
+        if response is not None:
+            dialog_logger.info("[Agent -> User] %s", response)
+            response_dict = {
+                "content": response,
+                "content_complete": True
+            }
+            if response_id is not None:
+                response_dict["response_id"] = response_id
+            await send_frame(websocket, response_dict)
+            await session_store.set(call_id, session.to_state())
+            return
+
+        # Stream partial content so Retell can start speaking early. Tiny
+        # deltas are coalesced so each frame carries a useful amount of text.
+        chunks = []
+        pending = ""
+        async for chunk in session.process_message_stream(message):
+            chunks.append(chunk)
+            pending += chunk
+            if len(pending) < MIN_STREAM_CHUNK:
+                continue
+            response_dict = {
+                "content": pending,
+                "content_complete": False
+            }
+            if response_id is not None:
+                response_dict["response_id"] = response_id
+            await send_frame(websocket, response_dict)
+            pending = ""
+
+        dialog_logger.info("[Agent -> User] %s", "".join(chunks))
+
+        # The final frame carries whatever text is still buffered
+        response_dict = {
+            "content": pending,
+            "content_complete": True
+        }
+        if response_id is not None:
+            response_dict["response_id"] = response_id
+        await send_frame(websocket, response_dict)
+        await session_store.set(call_id, session.to_state())
+    except Exception as e:
+        error_dict = {"error": str(e), "content_complete": True}
+        logging.error("WebSocket error: %s", e)
+        logging.error("Sending error to Retell: %s", error_dict)
+        await send_frame(websocket, error_dict)
+        await websocket.close()
+        await session_store.delete(call_id)
+
 @app.websocket("/llm-websocket/{call_id}")
 async def llm_websocket(websocket: WebSocket, call_id: str):
     """
     WebSocket endpoint for real-time communication with the LangChain agent.
     Receives messages from Retell, processes them with the agent, and sends responses back in the expected format.
     """
+    agent = websocket.app.state.agent
     await websocket.accept()
     # Send initial empty message so the user (pizzeria) can speak first
-    initial_response = {"content": "", "content_complete": True}
-    # logging.info(f"Sending to Retell: {initial_response}")  # Remove technical noise
-    await websocket.send_json(initial_response)
+    await websocket.send_text(_INITIAL_FRAME)
     session = None
+    keep_state = False
     try:
-        while True:
-            try:
-                data = await websocket.receive_json()
-                # logging.info(f"Received JSON from Retell: {data}")  # Remove technical noise
-            except Exception as e:
-                logging.error(f"Error receiving JSON: {e}")
-                break
-
-            # On first message, extract reservation params and create session
+        async for data in iter_frames(websocket):
+            # logging.info("Received JSON from Retell: %s", data)  # Remove technical noise
+            # On first message, resume a stored session (e.g. after a reconnect
+            # to another worker) or extract reservation params and create one
             if not session:
-                reservation_params = data.get("metadata") or data.get("reservation_params")
-                if not reservation_params:
-                    # Fallback for manual UI Retell test: use hardcoded test data
-                    reservation_params = {
-                        "date": "2024-03-20",
-                        "time": "19:00",
-                        "people": 4,
-                        "name": "John Doe"
-                    }
-                    logging.warning("No reservation params provided by Retell. Using fallback test data.")
-                session = ReservationSession(agent, reservation_params)
-                sessions[call_id] = session
+                state = await session_store.get(call_id)
+                if state is not None:
+                    session = ReservationSession.from_state(agent, state)
+                else:
+                    reservation_params = (
+                        data.get("metadata")
+                        or data.get("reservation_params")
+                        or _FALLBACK_PARAMS
+                    )
+                    if not reservation_params:
+                        logging.error("No reservation params provided by Retell. Closing call %s.", call_id)
+                        await websocket.close(code=1008)
+                        return
+                    session = ReservationSession(agent, reservation_params)
+                    await session_store.set(call_id, session.to_state())
+                # Persist the summarized history, so a resumed call picks it up
+                session.on_compacted = lambda: session_store.set(call_id, session.to_state())
 
             # Only respond to 'response_required' interaction_type
             interaction_type = data.get("interaction_type")
@@ -157,48 +372,56 @@ async def llm_websocket(websocket: WebSocket, call_id: str):
             message = None
             transcript = data.get("transcript")
             if transcript and isinstance(transcript, list) and len(transcript) > 0:
-                for entry in reversed(transcript):
-                    if entry.get("role") == "user":
-                        message = entry.get("content")
-                        break
+                # Only scan entries added since the previous turn; the full
+                # transcript is scanned only if no new user entry was added.
+                start = session.last_transcript_len
+                session.last_transcript_len = len(transcript)
+                message = latest_user_message(transcript, start) or latest_user_message(transcript)
 
             if not message:
-                error_dict = {"error": "No message provided.", "content_complete": True}
-                logging.error(f"Sending error to Retell: {error_dict}")
-                if response_id is not None:
-                    error_dict["response_id"] = response_id
-                await websocket.send_json(error_dict)
+                logging.error("Sending error to Retell: %s", _NO_MESSAGE_ERROR)
+                if response_id is None:
+                    await websocket.send_text(_NO_MESSAGE_ERROR)
+                else:
+                    await send_frame(websocket, {
+                        "error": "No message provided.",
+                        "content_complete": True,
+                        "response_id": response_id
+                    })
                 continue
 
-            # Only log dialog messages explicitly
-            dialog_logger.info(f"[User -> Agent] {message}")
-
-            response = await session.process_message(message)
-
-            dialog_logger.info(f"[Agent -> User] {response}")
-
-            response_dict = {
-                "content": response,
-                "content_complete": True
-            }
-            if response_id is not None:
-                response_dict["response_id"] = response_id
-            await websocket.send_json(response_dict)
-    except WebSocketDisconnect:
+            # Latest event wins: a newer response_required supersedes a turn
+            # that is still being generated, so stop spending tokens on it
+            if session.response_task and not session.response_task.done():
+                session.response_task.cancel()
+            session.response_task = asyncio.create_task(
+                respond_to_turn(websocket, session, call_id, message, response_id)
+            )
+    except WebSocketDisconnect as e:
         # logging.info("WebSocket disconnected")  # Remove technical noise
-        sessions.pop(call_id, None)
+        # A dropped connection may reconnect to another worker and resume the
+        # stored session; state that is never resumed expires with its TTL
+        keep_state = e.code != 1000
     except Exception as e:
         error_dict = {"error": str(e), "content_complete": True}
-        logging.error(f"WebSocket error: {e}")
-        logging.error(f"Sending error to Retell: {error_dict}")
-        await websocket.send_json(error_dict)
+        logging.error("WebSocket error: %s", e)
+        logging.error("Sending error to Retell: %s", error_dict)
+        await send_frame(websocket, error_dict)
         await websocket.close()
-        sessions.pop(call_id, None)
+    finally:
+        # Don't keep generating for a caller that has gone away. The reply is
+        # awaited so it can't save the session again after it is deleted.
+        if session and session.response_task:
+            session.response_task.cancel()
+            await asyncio.gather(session.response_task, return_exceptions=True)
+        if session and session._compaction_task:
+            session._compaction_task.cancel()
+            await asyncio.gather(session._compaction_task, return_exceptions=True)
+        if session and not keep_state:
+            await session_store.delete(call_id)
 
 @app.post("/call-reserve")
-async def call_reserve(request: ReservationRequest):
-    # Form a public LLM endpoint (ngrok url)
-    llm_url = f"{settings.host}/llm-websocket/{{call_id}}"  # Replace with your public address!
+async def call_reserve(request: ReservationRequest, http_request: Request):
     metadata = {
         "date": request.date,
         "time": request.time,
@@ -207,11 +430,27 @@ async def call_reserve(request: ReservationRequest):
     }
     try:
         result = await initiate_retell_call(
-            api_key=settings.retell_api_key,
+            client=http_request.app.state.retell_client,
+            api_key=RETELL_API_KEY,
             phone_number=request.phone_number,
-            llm_url=llm_url,
+            llm_url=LLM_URL_TEMPLATE,
             metadata=metadata
         )
         return {"status": "initiated", "retell_response": result}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # libuv event loop and C HTTP parser for lower per-request overhead
+    uvicorn.run(
+        "app.main:app",
+        host=settings.host,
+        port=settings.port,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_max_size=MAX_FRAME_SIZE,
+        workers=settings.workers
+    )
@@ -0,0 +1,89 @@
+from typing import Any, Dict, Optional
+import time
+from cachetools import TTLCache
+import orjson
+import redis.asyncio as redis
+
+from app.config import FrozenSettings
+
+
+class InMemorySessionStore:
+    """
+    Process-local session store. Sessions are only visible to one worker.
+    Bounded by size and TTL, so calls that never disconnect cleanly are evicted.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: int = 3600):
+        self._states: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, call_id: str) -> Optional[Dict[str, Any]]:
+        """Get the stored session state for a call."""
+        return self._states.get(call_id)
+
+    async def set(self, call_id: str, state: Dict[str, Any]):
+        """Store the session state for a call."""
+        self._states[call_id] = state
+
+    async def delete(self, call_id: str):
+        """Remove the session state for a call."""
+        self._states.pop(call_id, None)
+
+    async def count(self) -> int:
+        """Get the number of stored sessions."""
+        return len(self._states)
+
+    async def aclose(self):
+        """Release store resources."""
+
+
+class RedisSessionStore:
+    """
+    Redis-backed session store, shared by all workers and replicas.
+    Live call IDs are also tracked in a sorted set scored by expiry time, so
+    counting sessions doesn't scan the keyspace.
+    """
+
+    def __init__(self, url: str, ttl: int = 3600, prefix: str = "session:"):
+        self.ttl = ttl
+        self.prefix = prefix
+        self.index_key = "index:" + prefix
+        self._redis = redis.from_url(url)
+
+    async def get(self, call_id: str) -> Optional[Dict[str, Any]]:
+        """Get the stored session state for a call."""
+        raw = await self._redis.get(self.prefix + call_id)
+        return orjson.loads(raw) if raw is not None else None
+
+    async def set(self, call_id: str, state: Dict[str, Any]):
+        """Store the session state for a call, refreshing its expiry."""
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.set(self.prefix + call_id, orjson.dumps(state), ex=self.ttl)
+            pipe.zadd(self.index_key, {call_id: time.time() + self.ttl})
+            await pipe.execute()
+
+    async def delete(self, call_id: str):
+        """Remove the session state for a call."""
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.delete(self.prefix + call_id)
+            pipe.zrem(self.index_key, call_id)
+            await pipe.execute()
+
+    async def count(self) -> int:
+        """Get the number of stored sessions."""
+        async with self._redis.pipeline(transaction=False) as pipe:
+            # Drop index entries whose session keys have expired
+            pipe.zremrangebyscore(self.index_key, "-inf", time.time())
+            pipe.zcard(self.index_key)
+            _, count = await pipe.execute()
+        return count
+
+    async def aclose(self):
+        """Close the Redis connection pool."""
+        await self._redis.aclose()
+
+
+def create_session_store(settings: FrozenSettings):
+    """Create a Redis session store when REDIS_URL is set, else an in-memory one."""
+    if settings.redis_url:
+        return RedisSessionStore(settings.redis_url, ttl=settings.session_ttl)
+    return InMemorySessionStore(ttl=settings.session_ttl)
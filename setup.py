@@ -8,6 +8,10 @@ setup(
         "langchain",
         "langchain-openai",
         "pydantic",
+        "orjson",
+        "uvicorn[standard]",
+        "uvloop; sys_platform != 'win32'",
+        "httptools",
     ],
     python_requires=">=3.10",
 ) 
\ No newline at end of file
@@ -2,6 +2,9 @@ import pytest
 import os
 from unittest.mock import Mock
 
+# Run tests in parallel with `pytest -n auto`
+pytest_plugins = ["xdist"]
+
 
 @pytest.fixture(autouse=True)
 def mock_env_variables():
@@ -23,4 +26,37 @@ def mock_openai():
                 }
             }]
         }))
-        yield m 
\ No newline at end of file
+        yield m 
+
+
+@pytest.fixture(scope="module")
+def mock_langsmith_client():
+    """Mock LangSmith client fixture, patched once per test module."""
+    mock = Mock(return_value=Mock())
+    with pytest.MonkeyPatch.context() as m:
+        m.setattr("app.agent.get_langsmith_client", mock)
+        yield mock
+
+
+@pytest.fixture(scope="session")
+def tracer_cls():
+    """LangChain tracer class, imported once for isinstance checks."""
+    from langchain.callbacks.tracers import LangChainTracer
+    return LangChainTracer
+
+
+@pytest.fixture(scope="module")
+def agent(mock_langsmith_client):
+    """ReservationAgent built once per test module with the LangSmith client mocked."""
+    from app.agent import ReservationAgent
+    # Module fixtures run before the function-scoped mock_env_variables
+    with pytest.MonkeyPatch.context() as m:
+        m.setenv("OPENAI_API_KEY", "test_api_key")
+        return ReservationAgent()
+
+
+@pytest.fixture(autouse=True)
+def reset_langsmith_mocks(request):
+    """Give each test using the shared LangSmith client mock a fresh call history."""
+    if "mock_langsmith_client" in request.fixturenames:
+        request.getfixturevalue("mock_langsmith_client").reset_mock()
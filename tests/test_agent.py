@@ -5,8 +5,9 @@ import pytest
 from datetime import datetime
 from unittest.mock import Mock, patch, AsyncMock
 from langchain.agents import AgentExecutor
-from app.agent import initialize_agent, ReservationAgent, ChatPromptTemplate, ReservationSession
+from app.agent import initialize_agent, ReservationAgent, ChatPromptTemplate, ReservationSession, get_cache_control, ChatBatcher, fast_path_response
 from langchain.callbacks.tracers import LangChainTracer
+import app.agent as agent_module
 import asyncio
 import httpx
 
@@ -16,7 +17,10 @@ def mock_settings():
     """Mock settings fixture."""
     with patch('app.agent.get_settings') as mock:
         mock.return_value = Mock(
-            openrouter_api_key="test_api_key"
+            openrouter_api_key="test_api_key",
+            llm_model="openai/gpt-4o",
+            response_cache_enabled=False,
+            debug=False
         )
         yield mock
 
@@ -61,6 +65,16 @@ def test_initialize_agent_creation(mock_settings, mock_calendar, mock_langsmith,
     assert isinstance(agent.tools[1].name, str)
 
 
+def test_initialize_agent_uses_configured_model(mock_settings, mock_calendar, mock_langsmith, reservation_params):
+    """Test that initialize_agent uses the configured model and its caching rules."""
+    mock_settings.return_value.llm_model = "anthropic/claude-3.5-sonnet"
+    agent = initialize_agent(reservation_params)
+
+    llm = agent.agent.runnable.steps[-2].bound
+    assert llm.model_name == "anthropic/claude-3.5-sonnet"
+    assert llm.extra_body == {"cache_control": {"type": "ephemeral"}}
+
+
 def test_agent_with_valid_availability_check(mock_settings, mock_calendar, mock_langsmith, reservation_params):
     """Test agent's availability check with valid parameters."""
     agent = initialize_agent(reservation_params)
@@ -76,6 +90,20 @@ def test_agent_with_valid_availability_check(mock_settings, mock_calendar, mock_
     assert isinstance(result["suggested_times"], list)
 
 
+async def test_agent_async_availability_check(mock_settings, mock_calendar, mock_langsmith, reservation_params):
+    """Test that the async availability check awaits both calendar lookups."""
+    calendar_instance = mock_calendar.return_value
+    calendar_instance.acheck_availability = AsyncMock(return_value=True)
+    calendar_instance.aget_available_times = AsyncMock(return_value=["19:00", "19:30"])
+    agent = initialize_agent(reservation_params)
+
+    result = await agent.tools[0].ainvoke({"date": "2024-03-20", "time": "19:00"})
+
+    assert result == {"available": True, "suggested_times": ["19:00", "19:30"]}
+    calendar_instance.acheck_availability.assert_awaited_once()
+    calendar_instance.aget_available_times.assert_awaited_once()
+
+
 def test_agent_with_invalid_date(mock_settings, mock_calendar, mock_langsmith, reservation_params):
     """Test agent's availability check with invalid date format."""
     agent = initialize_agent(reservation_params)
@@ -88,6 +116,15 @@ def test_agent_with_invalid_date(mock_settings, mock_calendar, mock_langsmith, r
     assert "error" in result
 
 
+async def test_sync_and_async_availability_reject_same_dates(mock_settings, mock_calendar, mock_langsmith, reservation_params):
+    """Test that both availability tool variants report the same date errors."""
+    tool = initialize_agent(reservation_params).tools[0]
+    for date in ["invalid-date", "2024-13-45"]:
+        expected = tool.invoke({"date": date, "time": "19:00"})
+        assert "error" in expected
+        assert await tool.ainvoke({"date": date, "time": "19:00"}) == expected
+
+
 def test_agent_memory_initialization(mock_settings, mock_calendar, mock_langsmith, reservation_params):
     """Test that agent's memory is properly initialized."""
     agent = initialize_agent(reservation_params)
@@ -97,6 +134,31 @@ def test_agent_memory_initialization(mock_settings, mock_calendar, mock_langsmit
     assert agent.memory.return_messages is True
 
 
+def test_prompt_keeps_static_prefix(reservation_params):
+    """Test that reservation details follow the static system instructions."""
+    from app.agent import _PROMPT, prompt_variables
+    system = _PROMPT.messages[0].prompt
+    first = system.format(**prompt_variables(reservation_params))
+    second = system.format(**prompt_variables({**reservation_params, "name": "Jane Roe"}))
+    prefix = first[:first.index("Your reservation details are:")]
+    assert second.startswith(prefix)
+    assert "John Doe" not in prefix
+
+
+def test_cache_control_only_for_anthropic_models():
+    """Test that explicit cache breakpoints are only sent to Anthropic models."""
+    assert get_cache_control("anthropic/claude-3.5-sonnet") == {"cache_control": {"type": "ephemeral"}}
+    assert get_cache_control("openai/gpt-4o") is None
+
+
+def test_fast_path_only_matches_bare_acknowledgements():
+    """Test that only short acknowledgements skip the agent."""
+    assert fast_path_response("Okay.") == "Great, thank you."
+    assert fast_path_response("  Thank you! ") == "Thank you!"
+    assert fast_path_response("Yes") is None
+    assert fast_path_response("Okay, for how many people?") is None
+
+
 def test_agent_prompt_template_vars():
     prompt = ChatPromptTemplate.from_messages([
         ("system", "You are a helpful restaurant reservation assistant.\nCurrent reservation details:\n- Date: {date}\n- Time: {time}\n- Number of people: {people}\n- Customer name: {name}\nHelp the customer with their reservation request.\nAlways be polite and professional.\nIf you need to check availability, use the check_availability tool."),
@@ -106,7 +168,6 @@ def test_agent_prompt_template_vars():
     assert "input" in template_vars or "input" in prompt.messages[1][1]
 
 
-@pytest.mark.asyncio
 async def test_agent_conversation_flow(mock_settings, mock_calendar, mock_langsmith, reservation_params):
     """Test basic conversation flow with the agent."""
     agent = ReservationAgent()
@@ -116,7 +177,6 @@ async def test_agent_conversation_flow(mock_settings, mock_calendar, mock_langsm
     agent.process_message.assert_awaited_once()
 
 
-@pytest.mark.asyncio
 def test_agent_full_reservation_dialog(mock_settings, mock_calendar, mock_langsmith, reservation_params):
     """Test full reservation dialog flow with mocked agent responses."""
     agent = ReservationAgent()
@@ -142,7 +202,136 @@ def test_agent_full_reservation_dialog(mock_settings, mock_calendar, mock_langsm
         session.chat_history.append({"role": "assistant", "content": response})
 
 
-@pytest.mark.asyncio
+async def test_chat_batcher_batches_concurrent_requests():
+    """Test that concurrent chat requests share one abatch call."""
+    executor = Mock()
+    executor.abatch = AsyncMock(side_effect=lambda inputs, **kwargs: [
+        {"output": f"reply to {item['input']}"} for item in inputs
+    ])
+    agent = Mock()
+    agent.batch_executor = executor
+    batcher = ChatBatcher(agent, max_batch_size=8, max_wait=0.05)
+
+    responses = await asyncio.gather(*(batcher.submit(f"message {i}") for i in range(3)))
+    await batcher.aclose()
+
+    assert responses == ["reply to message 0", "reply to message 1", "reply to message 2"]
+    executor.abatch.assert_awaited_once()
+    assert executor.abatch.await_args.kwargs["config"] == {"max_concurrency": 8}
+
+
+async def test_chat_batcher_does_not_wait_for_slow_batch():
+    """Test that a slow batch doesn't hold up the batches queued after it."""
+    release = asyncio.Event()
+
+    async def abatch(inputs, **kwargs):
+        if inputs[0]["input"] == "slow":
+            await release.wait()
+        return [{"output": f"reply to {item['input']}"} for item in inputs]
+
+    agent = Mock()
+    agent.batch_executor = Mock(abatch=abatch)
+    batcher = ChatBatcher(agent, max_batch_size=1, max_wait=0.01)
+
+    slow = asyncio.create_task(batcher.submit("slow"))
+    # Let the slow request be taken off the queue as its own batch
+    await asyncio.sleep(0.05)
+    assert await asyncio.wait_for(batcher.submit("fast"), timeout=1) == "reply to fast"
+    assert not slow.done()
+
+    release.set()
+    assert await slow == "reply to slow"
+    await batcher.aclose()
+
+
+async def test_session_streams_response_tokens(reservation_params):
+    """Test that streamed tokens are yielded and recorded in the chat history."""
+    from langchain_core.messages import AIMessageChunk
+
+    async def astream_events(inputs, version):
+        yield {"event": "on_chat_model_start", "data": {}}
+        for content in ["", "Hello", ", I'd like a table."]:
+            yield {"event": "on_chat_model_stream", "data": {"chunk": AIMessageChunk(content=content)}}
+
+    session = ReservationSession(Mock(response_cache=None), reservation_params)
+    session.executor = Mock(astream_events=astream_events)
+    chunks = [chunk async for chunk in session.process_message_stream("Hi, how can I help?")]
+
+    assert chunks == ["Hello", ", I'd like a table."]
+    assert session.chat_history[-1] == {"role": "assistant", "content": "Hello, I'd like a table."}
+
+
+async def test_session_stream_retries_before_first_token(reservation_params, monkeypatch):
+    """Test that a rate-limited stream is retried if nothing was sent yet."""
+    import openai
+    from tenacity import wait_none
+    from langchain_core.messages import AIMessageChunk
+    monkeypatch.setitem(agent_module._LLM_RETRY, "wait", wait_none())
+    request = httpx.Request("POST", "https://openrouter.ai/api/v1/chat/completions")
+    attempts = []
+
+    async def astream_events(inputs, version):
+        attempts.append(inputs["input"])
+        if len(attempts) == 1:
+            raise openai.RateLimitError("rate limited", response=httpx.Response(429, request=request), body=None)
+        yield {"event": "on_chat_model_stream", "data": {"chunk": AIMessageChunk(content="Hello")}}
+
+    session = ReservationSession(Mock(response_cache=None), reservation_params)
+    session.executor = Mock(astream_events=astream_events)
+    chunks = [chunk async for chunk in session.process_message_stream("Hi")]
+
+    assert chunks == ["Hello"]
+    assert len(attempts) == 2
+
+
+async def test_session_state_round_trip(reservation_params):
+    """Test that a session survives a round trip through the session store."""
+    from app.sessions import InMemorySessionStore
+    store = InMemorySessionStore()
+    session = ReservationSession(Mock(), reservation_params)
+    session.chat_history.append({"role": "user", "content": "Hello"})
+    session.last_transcript_len = 3
+
+    await store.set("call-1", session.to_state())
+    restored = ReservationSession.from_state(Mock(), await store.get("call-1"))
+
+    assert restored.reservation_params == reservation_params
+    assert restored.chat_history == session.chat_history
+    assert restored.last_transcript_len == 3
+    assert await store.count() == 1
+    await store.delete("call-1")
+    assert await store.get("call-1") is None
+
+
+async def test_session_history_is_summarized_at_limit(reservation_params):
+    """Test that old history is summarized in the background without delaying replies."""
+    from langchain_core.messages import AIMessage
+    from app.agent import HISTORY_LIMIT
+    release = asyncio.Event()
+
+    async def summarize(messages):
+        await release.wait()
+        return AIMessage(content="Asked for a table.")
+
+    agent = Mock()
+    agent.summary_llm.ainvoke = summarize
+    session = ReservationSession(agent, reservation_params)
+    session.on_compacted = AsyncMock()
+    for i in range(HISTORY_LIMIT // 2 - 1):
+        session._record_exchange(f"staff {i}", f"customer {i}")
+    # The summary is still pending, yet new turns are recorded immediately
+    session._record_exchange("staff last", "customer last")
+    assert session.chat_history[-1] == {"role": "assistant", "content": "customer last"}
+
+    release.set()
+    await session._compaction_task
+
+    assert session.chat_history[0] == {"role": "system", "content": "Earlier: Asked for a table."}
+    assert len(session.chat_history) == HISTORY_LIMIT // 2 + 1
+    assert session.chat_history[-1] == {"role": "assistant", "content": "customer last"}
+    session.on_compacted.assert_awaited_once()
+
+
 async def test_agent_logic_with_emulated_pizzeria():
     """
     Test agent logic with emulated pizzeria (Retell) responses.
@@ -179,7 +368,6 @@ async def test_agent_logic_with_emulated_pizzeria():
     # You can add keyword checks in agent responses here
 
 
-@pytest.mark.asyncio
 async def test_agent_uses_reservation_params():
     """
     The agent should use the provided reservation parameters in its responses.
@@ -226,7 +414,6 @@ async def test_agent_uses_reservation_params():
     assert reservation_params["time"] in all_responses or "time" in all_responses
 
 
-@pytest.mark.asyncio
 async def test_integration_retell_emulation():
     """
     Integration test: Emulate Retell AI sending pizzeria messages and check agent's behavior with session context.
@@ -262,4 +449,37 @@ async def test_integration_retell_emulation():
     assert (
         "2024" in all_responses and ("march" in all_responses or "03-20" in all_responses or "20th" in all_responses)
     ) or reservation_params["date"] in all_responses or "date" in all_responses
-    assert "19:00" in all_responses or "7:00" in all_responses or "7 pm" in all_responses or "time" in all_responses 
\ No newline at end of file
+    assert "19:00" in all_responses or "7:00" in all_responses or "7 pm" in all_responses or "time" in all_responses 
+
+async def test_session_sends_same_system_prompt_every_turn(reservation_params):
+    """Test that every turn passes the same reservation details and only appends history."""
+    agent = Mock(response_cache=None)
+    agent.executor.ainvoke = AsyncMock(return_value={"output": "Sure."})
+    session = ReservationSession(agent, reservation_params)
+
+    await session.process_message("Hello")
+    await session.process_message("For four people")
+
+    first, second = (call.args[0] for call in agent.executor.ainvoke.await_args_list)
+    for key in ("date", "time", "people", "name"):
+        assert first[key] == second[key] == reservation_params[key]
+    assert second["chat_history"][:2] == [
+        {"role": "user", "content": "Hello"},
+        {"role": "assistant", "content": "Sure."}
+    ]
+
+
+async def test_response_cache_skips_repeated_turns(reservation_params):
+    """Test that an identical turn of the same reservation reuses the cached reply."""
+    from cachetools import LRUCache
+    agent = Mock(response_cache=LRUCache(maxsize=8))
+    agent.executor.ainvoke = AsyncMock(return_value={"output": "For four people."})
+
+    first = ReservationSession(agent, reservation_params)
+    second = ReservationSession(agent, reservation_params)
+    other = ReservationSession(agent, {**reservation_params, "name": "Jane Roe"})
+    for session in (first, second, other):
+        assert await session.process_message("Hello, Pizza Palace.") == "For four people."
+
+    assert agent.executor.ainvoke.await_count == 2
+    assert second.chat_history[-1] == {"role": "assistant", "content": "For four people."}
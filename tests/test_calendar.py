@@ -0,0 +1,56 @@
+import pytest
+from datetime import datetime
+from app.calendar import ReservationCalendar
+
+
+@pytest.fixture
+def calendar():
+    """Calendar with a small per-slot capacity."""
+    return ReservationCalendar(slot_capacity=6)
+
+
+def test_availability_tracks_slot_load(calendar):
+    """Test that reservations reduce the remaining capacity of their slot only."""
+    calendar.add_reservation(datetime(2024, 3, 20, 19, 0), 4, "John Doe", "+1234567890")
+
+    assert calendar.check_availability(datetime(2024, 3, 20), "19:00", 2) is True
+    assert calendar.check_availability(datetime(2024, 3, 20), "19:00", 3) is False
+    assert calendar.check_availability(datetime(2024, 3, 20), "19:30", 6) is True
+    assert calendar.check_availability(datetime(2024, 3, 21), "19:00", 6) is True
+
+
+def test_available_times_exclude_full_slots(calendar):
+    """Test that full slots are not suggested."""
+    calendar.add_reservation(datetime(2024, 3, 20, 19, 0), 6, "John Doe", "+1234567890")
+
+    times = calendar.get_available_times(datetime(2024, 3, 20), 2)
+    assert "19:00" not in times
+    assert "19:30" in times
+
+
+def test_cancel_reservation_frees_slot(calendar):
+    """Test that cancelling releases the slot capacity exactly once."""
+    reservation = calendar.add_reservation(datetime(2024, 3, 20, 19, 0), 6, "John Doe", "+1234567890")
+
+    assert calendar.cancel_reservation(reservation.reservation_id) is True
+    assert calendar.cancel_reservation(reservation.reservation_id) is True
+    assert calendar.check_availability(datetime(2024, 3, 20), "19:00", 6) is True
+    assert calendar.cancel_reservation("missing") is False
+
+
+def test_reservation_ids_are_unique(calendar):
+    """Test that reservations made in the same second get distinct IDs."""
+    first = calendar.add_reservation(datetime(2024, 3, 20, 19, 0), 2, "John Doe", "+1234567890")
+    second = calendar.add_reservation(datetime(2024, 3, 20, 19, 0), 2, "Jane Roe", "+1234567890")
+
+    assert first.reservation_id != second.reservation_id
+    assert calendar.get_reservation(second.reservation_id) is second
+
+
+async def test_async_availability_matches_sync(calendar):
+    """Test that the async variants return the same results as the sync lookups."""
+    calendar.add_reservation(datetime(2024, 3, 20, 19, 0), 6, "John Doe", "+1234567890")
+
+    assert await calendar.acheck_availability(datetime(2024, 3, 20), "19:00", 1) is False
+    assert await calendar.aget_available_times(datetime(2024, 3, 20), 2) == \
+        calendar.get_available_times(datetime(2024, 3, 20), 2)
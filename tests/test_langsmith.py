@@ -1,26 +1,5 @@
-import pytest
-from unittest.mock import Mock, patch, AsyncMock
-from langsmith import Client
-from langchain.callbacks.tracers import LangChainTracer
-from app.agent import ReservationAgent, initialize_agent
-
-
-@pytest.fixture
-def mock_langsmith_client():
-    """Mock LangSmith client fixture."""
-    with patch('app.agent.get_langsmith_client') as mock:
-        client_instance = Mock(spec=Client)
-        mock.return_value = client_instance
-        yield mock
-
-
-@pytest.fixture
-def mock_tracer():
-    """Mock LangChain tracer fixture."""
-    with patch('app.agent.LangChainTracer') as mock:
-        tracer_instance = Mock(spec=LangChainTracer)
-        mock.return_value = tracer_instance
-        yield mock
+from unittest.mock import Mock
+from app.agent import ReservationAgent, get_langsmith_client, get_tracer
 
 
 def test_langsmith_client_initialization(mock_langsmith_client):
@@ -31,37 +10,43 @@ def test_langsmith_client_initialization(mock_langsmith_client):
     assert client is mock_langsmith_client.return_value
 
 
-def test_tracer_initialization_in_reservation_agent(mock_langsmith_client):
-    """Test that LangChain tracer is properly initialized in ReservationAgent."""
-    agent = ReservationAgent()
-    assert isinstance(agent.llm.callbacks[0], LangChainTracer)
-    assert agent.llm.callbacks[0].client is mock_langsmith_client.return_value
+def test_tracing_disabled_without_api_key(mock_langsmith_client, monkeypatch, request):
+    """Test that no LangSmith client or tracer is created without an API key."""
+    # get_langsmith_client is the real function, imported before the patch.
+    # Its cached None must not disable tracing for later tests.
+    monkeypatch.setattr("app.agent.get_settings", Mock(return_value=Mock(langsmith_api_key="")))
+    get_langsmith_client.cache_clear()
+    request.addfinalizer(get_langsmith_client.cache_clear)
+    assert get_langsmith_client() is None
+    monkeypatch.setattr(mock_langsmith_client, "return_value", None)
+    assert get_tracer() is None
+
+
+def test_tracer_is_shared_between_agents(agent):
+    """Test that agents reuse one tracer for the same LangSmith client."""
+    other = ReservationAgent()
+    assert agent.llm.callbacks[0] is other.llm.callbacks[0]
 
 
-def test_tracer_initialization_in_initialize_agent(mock_langsmith_client):
-    """Test that LangChain tracer is properly initialized in initialize_agent."""
-    # Just check that tracer is used in ReservationAgent, since agent from initialize_agent is not directly accessible
-    agent = ReservationAgent()
-    assert isinstance(agent.llm.callbacks[0], LangChainTracer)
+def test_tracer_and_callbacks(agent, mock_langsmith_client, tracer_cls):
+    """Test that ReservationAgent's LLM is traced by a single LangChain tracer."""
+    assert isinstance(agent.llm.callbacks[0], tracer_cls)
     assert agent.llm.callbacks[0].client is mock_langsmith_client.return_value
+    assert len(agent.llm.callbacks) == 1
 
 
-@pytest.mark.asyncio
-async def test_agent_tracing(mock_langsmith_client):
+async def test_agent_tracing(agent, monkeypatch):
     """Test that agent interactions are properly traced."""
-    agent = ReservationAgent()
-    agent.process_message = AsyncMock(return_value="I can help you with that reservation. Let me check the availability.")
-    message = "I'd like to make a reservation for 4 people tomorrow at 7 PM"
-    response = await agent.process_message(message)
-    assert response == "I can help you with that reservation. Let me check the availability."
-    agent.process_message.assert_awaited_once()
+    reply = "I can help you with that reservation. Let me check the availability."
+    called = []
 
+    async def process_message(message):
+        called.append(message)
+        return reply
 
-def test_callback_initialization(mock_langsmith_client):
-    """Test that callbacks are properly initialized with tracer."""
-    agent = ReservationAgent()
-    
-    # Verify that the LLM has the callbacks
-    assert agent.llm.callbacks is not None
-    assert len(agent.llm.callbacks) == 1
-    assert isinstance(agent.llm.callbacks[0], LangChainTracer) 
\ No newline at end of file
+    # The agent is shared by the module, so the stub is removed after the test
+    monkeypatch.setattr(agent, "process_message", process_message, raising=False)
+    message = "I'd like to make a reservation for 4 people tomorrow at 7 PM"
+    response = await agent.process_message(message)
+    assert response == reply
+    assert called == [message]
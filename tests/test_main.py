@@ -0,0 +1,198 @@
+import pytest
+import httpx
+import orjson
+from tenacity import wait_none
+from app.main import initiate_retell_call, is_transient_retell_error
+
+
+@pytest.fixture
+def no_retry_wait(monkeypatch):
+    """Retry Retell calls without backoff delays."""
+    monkeypatch.setattr(initiate_retell_call.retry, "wait", wait_none())
+
+
+def make_client(statuses, requests):
+    """Retell client answering with the given status codes in order."""
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(statuses[len(requests) - 1], json={"call_id": "call-1"})
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def status_error(status_code):
+    request = httpx.Request("POST", "https://api.retellai.com/v1/call")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status_code, request=request))
+
+
+def test_only_unplaced_calls_are_transient():
+    """Test that only errors where no call can have been placed are retried."""
+    request = httpx.Request("POST", "https://api.retellai.com/v1/call")
+    assert is_transient_retell_error(httpx.ConnectError("refused", request=request))
+    assert is_transient_retell_error(httpx.ConnectTimeout("timeout", request=request))
+    assert is_transient_retell_error(status_error(503))
+    assert not is_transient_retell_error(httpx.ReadTimeout("timeout", request=request))
+    assert not is_transient_retell_error(status_error(502))
+    assert not is_transient_retell_error(status_error(504))
+    assert not is_transient_retell_error(status_error(400))
+
+
+async def test_retell_call_retries_unavailable(no_retry_wait):
+    """Test that a 503 is retried until the call is placed."""
+    requests = []
+    async with make_client([503, 503, 200], requests) as client:
+        response = await initiate_retell_call(client, "key", "+1234567890", "wss://llm")
+
+    assert response == {"call_id": "call-1"}
+    assert len(requests) == 3
+
+
+async def test_retell_call_gives_up_after_three_attempts(no_retry_wait):
+    """Test that retries stop after three attempts and re-raise the error."""
+    requests = []
+    async with make_client([503, 503, 503], requests) as client:
+        with pytest.raises(httpx.HTTPStatusError):
+            await initiate_retell_call(client, "key", "+1234567890", "wss://llm")
+
+    assert len(requests) == 3
+
+
+async def test_retell_call_does_not_retry_gateway_timeout(no_retry_wait):
+    """Test that a 504 is not retried, since the call may have been placed."""
+    requests = []
+    async with make_client([504, 200], requests) as client:
+        with pytest.raises(httpx.HTTPStatusError):
+            await initiate_retell_call(client, "key", "+1234567890", "wss://llm")
+
+    assert len(requests) == 1
+
+
+@pytest.fixture
+def client():
+    """Test client whose websocket sessions use a stub agent."""
+    from unittest.mock import Mock
+    from fastapi.testclient import TestClient
+    from app.main import app
+    with TestClient(app) as test_client:
+        app.state.agent = Mock(response_cache=None)
+        yield test_client
+
+
+def start_call(ws):
+    """Read the initial frame and send the call's reservation metadata."""
+    ws.receive_text()
+    ws.send_text(orjson.dumps({
+        "interaction_type": "update_only",
+        "metadata": {"date": "2024-03-20", "time": "19:00", "people": 4, "name": "John Doe"},
+        "transcript": []
+    }).decode())
+
+
+def test_session_kept_after_dropped_connection(client):
+    """Test that a dropped call can resume its session, while a finished one is removed."""
+    from app.main import session_store
+    with client.websocket_connect("/llm-websocket/dropped") as ws:
+        start_call(ws)
+        ws.close(code=1006)
+    with client.websocket_connect("/llm-websocket/finished") as ws:
+        start_call(ws)
+
+    assert client.get("/metrics").json() == {"sessions": 1}
+    assert client.portal.call(session_store.get, "dropped") is not None
+    client.portal.call(session_store.delete, "dropped")
+
+
+def stream_replies(monkeypatch, replies):
+    """
+    Make sessions stream the given deltas for each message; None waits forever.
+    Returns the list of messages whose replies were cancelled.
+    """
+    import asyncio
+    from app.agent import ReservationSession
+    cancelled = []
+
+    async def process_message_stream(self, message):
+        try:
+            for delta in replies[message]:
+                if delta is None:
+                    await asyncio.sleep(60)
+                yield delta
+        except asyncio.CancelledError:
+            cancelled.append(message)
+            raise
+
+    monkeypatch.setattr(ReservationSession, "process_message_stream", process_message_stream)
+    return cancelled
+
+
+def response_required(response_id, *messages):
+    return orjson.dumps({
+        "interaction_type": "response_required",
+        "response_id": response_id,
+        "transcript": [{"role": "user", "content": message} for message in messages]
+    }).decode()
+
+
+def receive_reply(ws):
+    """Receive frames until one completes a response."""
+    frames = []
+    while not frames or not frames[-1]["content_complete"]:
+        frames.append(orjson.loads(ws.receive_text()))
+    return frames
+
+
+def test_superseded_reply_never_completes(client, monkeypatch):
+    """Test that a newer response_required cancels the reply still being generated."""
+    cancelled = stream_replies(monkeypatch, {
+        "First question": ["I'd like to book a table", None, "never sent"],
+        "Second question": ["For four people, please."]
+    })
+    with client.websocket_connect("/llm-websocket/superseded") as ws:
+        start_call(ws)
+        ws.send_text(response_required(1, "First question"))
+        assert orjson.loads(ws.receive_text())["response_id"] == 1
+        ws.send_text(response_required(2, "First question", "Second question"))
+        frames = receive_reply(ws)
+
+    assert cancelled == ["First question"]
+    assert all(frame["response_id"] == 2 for frame in frames)
+    assert "".join(frame["content"] for frame in frames) == "For four people, please."
+
+
+def test_short_deltas_are_coalesced(client, monkeypatch):
+    """Test that deltas under 20 characters are merged into larger frames."""
+    stream_replies(monkeypatch, {
+        "Hello": ["Hi ", "there, ", "a table for 4 please", " at", " seven."]
+    })
+    with client.websocket_connect("/llm-websocket/coalesced") as ws:
+        start_call(ws)
+        ws.send_text(response_required(1, "Hello"))
+        frames = receive_reply(ws)
+
+    assert [frame["content"] for frame in frames] == ["Hi there, a table for 4 please", " at seven."]
+    assert [frame["content_complete"] for frame in frames] == [False, True]
+
+
+def test_call_without_metadata_is_closed(client, monkeypatch):
+    """Test that a call without reservation params is closed outside dev mode."""
+    from starlette.websockets import WebSocketDisconnect
+    monkeypatch.setattr("app.main._FALLBACK_PARAMS", None)
+    with client.websocket_connect("/llm-websocket/no-metadata") as ws:
+        ws.receive_text()
+        ws.send_text(response_required(1, "Hello"))
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_text()
+
+    assert closed.value.code == 1008
+
+
+def test_oversized_frame_is_rejected(client):
+    """Test that frames above MAX_FRAME_SIZE close the connection unparsed."""
+    from starlette.websockets import WebSocketDisconnect
+    from app.main import MAX_FRAME_SIZE
+    with client.websocket_connect("/llm-websocket/oversized") as ws:
+        ws.receive_text()
+        ws.send_text("x" * (MAX_FRAME_SIZE + 1))
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_text()
+
+    assert closed.value.code == 1009